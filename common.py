@@ -1,21 +1,46 @@
+import json
 import re
+from functools import lru_cache
 from datetime import datetime
+from typing import Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DATETIME_FORMAT = "%y-%m-%d %H:%M:%S.%f"
+NAME_SEPARATOR_RE = re.compile(r"[\s_]+")
+NON_WORD_RE = re.compile(r"\W")
 
 def json_default(obj):
     if isinstance(obj, datetime):
         return datetime.strftime(obj, DATETIME_FORMAT)
     raise TypeError
 
+def json_dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data, default=json_default).encode('utf-8')
+
+def json_loads(content: Union[bytes, str]):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def load_timestamp(string: str) -> float:
+    return datetime.strptime(string, DATETIME_FORMAT).timestamp()
+
 def normalized_split(name: str) -> str:
-    for part in re.split(r"[\s_]+", name):
+    for part in NAME_SEPARATOR_RE.split(name):
         if part == "&":
             part = "and"
-        part = re.sub(r"\W", "", part.lower())
+        part = NON_WORD_RE.sub("", part.lower())
         if part:
             yield part
 
+# Same names are normalized over and over within a run
+@lru_cache(maxsize=4096)
 def normalize_name(name: str) -> str:
     return '_'.join(normalized_split(name))
 
@@ -24,12 +49,9 @@ def normalized_search(keys, name):
     exact_name = "_".join(parts)
     if exact_name in keys:
         return [exact_name]
-    results = []
-    regex = r".*?".join(parts)
-    for key in keys:
-        if re.search(regex, key):
-            results.append(key)
-    return results
+    # Keys are already normalized, so only the fuzzy fallback has to scan them
+    pattern = re.compile(r".*?".join(parts))
+    return [key for key in keys if pattern.search(key)]
 
 class AppError(Exception):
     def __init__(self, message):
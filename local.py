@@ -3,47 +3,119 @@ import re
 import os.path
 from pathlib import Path
 from itertools import chain
-from datetime import datetime
 from collections.abc import Iterator
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED
 
-from common import DATETIME_FORMAT, AppError, MultipleSavesFoundError, SaveNotFoundError, json_default, normalize_name, normalized_search
+from common import AppError, MultipleSavesFoundError, SaveNotFoundError, json_default, json_dumps, json_loads, load_timestamp, normalize_name, normalized_search
 
-LOCAL_REGISTRY_VERSION = "1.0"
+LOCAL_REGISTRY_VERSION = "1.1"
+# 1.0 stored timestamps as formatted strings, 1.1 stores them as POSIX floats
+LEGACY_LOCAL_REGISTRY_VERSIONS = ("1.0",)
+SAVE_FIELDS = ('name', 'root', 'filters', 'version', 'last_sync')
+# Fastest deflate level, most of the size gain for a fraction of the cpu time of the default
+ARCHIVE_COMPRESSLEVEL = 1
+
+class RegistryFile:
+    # Changes are appended to the journal and merged into the registry file only once it grows too long
+    def __init__(self, registry_file):
+        self.registry_file = Path(registry_file)
+        self.journal_file = self.registry_file.with_suffix('.log')
+        self.journal_length = 0
+
+    def load(self) -> dict[str, dict]:
+        registry = {}
+        if self.registry_file.exists():
+            with open(self.registry_file, 'rb') as fio:
+                data = json_loads(fio.read())
+            legacy = data['version'] in LEGACY_LOCAL_REGISTRY_VERSIONS
+            if data['version'] != LOCAL_REGISTRY_VERSION and not legacy:
+                raise ValueError(f"Local registry version: {data['version']} is not supported.")
+            registry = data['saves']
+            if legacy:
+                for save in registry.values():
+                    if save['last_sync']:
+                        save['last_sync'] = load_timestamp(save['last_sync'])
+        journal_length = self._replay_journal(registry)
+        if journal_length is None:
+            # Journal is damaged, rewrite it into the registry file before appending anything to it
+            self.save(registry)
+        else:
+            self.journal_length = journal_length
+        return registry
+
+    def _replay_journal(self, registry):
+        if not self.journal_file.exists():
+            return 0
+        length = 0
+        with open(self.journal_file, 'rb') as fio:
+            for line in fio:
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    # Incomplete last record from an interrupted write
+                    return None
+                if record['op'] == 'set':
+                    registry[record['id']] = record['save']
+                elif record['op'] == 'delete':
+                    registry.pop(record['id'], None)
+                length += 1
+        return length
+
+    def save(self, registry):
+        data = {'version': LOCAL_REGISTRY_VERSION, 'saves': registry}
+        with open(self.registry_file, 'w') as fio:
+            json.dump(data, fio, indent=4, default=json_default)
+        self.journal_file.unlink(missing_ok=True)
+        self.journal_length = 0
+
+    def append(self, records, registry_size) -> bool:
+        # Returns True once the journal is long enough to be merged back with save()
+        with open(self.journal_file, 'ab') as fio:
+            for record in records:
+                fio.write(json_dumps(record) + b'\n')
+        self.journal_length += len(records)
+        return self.journal_length > 2 * registry_size
 
 class Local:
-    def __init__(self, registry_file=None) -> None:
-        if registry_file is None:
-            registry_file = Path(__file__).parent.joinpath("registry.json")
-        self.registry_file = registry_file
+    # Registry is kept by a storage object with load() and save(registry),
+    # storages that also have append(records, registry_size) are given just the changes
+    # and ask for a full save() when they need one
+    def __init__(self, registry=None) -> None:
+        if registry is None:
+            registry = Path(__file__).parent.joinpath("registry.json")
+        if not hasattr(registry, 'load'):
+            registry = RegistryFile(registry)
+        self.storage = registry
         self._load_registry()
-    
+
     def _load_registry(self):
-        if not self.registry_file.exists():
-            self._registry = {}
-            return
-        with open(self.registry_file) as fio:
-            data = json.load(fio)
-        if data['version'] != LOCAL_REGISTRY_VERSION:
-            raise ValueError(f"Local registry version: {data['version']} is not supported.")
-        registry = data['saves']
+        registry = self.storage.load()
         for id_name, save in registry.items():
-            if save['last_sync']:
-                save['last_sync'] = datetime.strptime(save['last_sync'], DATETIME_FORMAT)
             save['last_modification'] = self._get_last_mod_time(save)
             save['id_name'] = id_name
         self._registry = registry
 
     def _save_registry(self):
-        data = {'version': LOCAL_REGISTRY_VERSION}
         registry = {}
         for id_name, save in self._registry.items():
-            save_data = {k: v for k, v in save.items() if k in ('name', 'root', 'filters', 'version')}
-            save_data['last_sync'] = datetime.strftime(save['last_sync'], DATETIME_FORMAT) if save['last_sync'] else None
-            registry[id_name] = save_data
-        data['saves'] = registry
-        with open(self.registry_file, 'w') as fio:
-            json.dump(data, fio, indent=4, default=json_default)
+            registry[id_name] = self._get_save_data(save)
+        self.storage.save(registry)
+
+    def _append_journal(self, *records):
+        if not hasattr(self.storage, 'append'):
+            self._save_registry()
+            return
+        if self.storage.append(records, len(self._registry)):
+            self._save_registry()
+
+    def _journal_set(self, save):
+        return {'op': 'set', 'id': save['id_name'], 'save': self._get_save_data(save)}
+
+    def _journal_delete(self, id_name):
+        return {'op': 'delete', 'id': id_name}
+
+    def _get_save_data(self, save):
+        return {k: v for k, v in save.items() if k in SAVE_FIELDS}
 
     def get_registry(self):
         return self._registry
@@ -62,7 +134,7 @@ class Local:
         }
         save['last_modification'] = self._get_last_mod_time(save)
         self._registry[id_name] = save
-        self._save_registry()
+        self._append_journal(self._journal_set(save))
 
     def edit(self, save_name, new_name=None, root=None, filters=None, version=None, last_sync=None):
         save = self._registry[save_name]
@@ -74,6 +146,7 @@ class Local:
             save['version'] = version
         if last_sync:
             save['last_sync'] = last_sync
+        records = []
         if new_name:
             save['name'] = new_name
             new_id_name = normalize_name(new_name)
@@ -81,11 +154,13 @@ class Local:
                 save['id_name'] = new_id_name
                 self._registry[new_id_name] = save
                 del self._registry[save_name]
-        self._save_registry()
+                records.append(self._journal_delete(save_name))
+        records.append(self._journal_set(save))
+        self._append_journal(*records)
 
     def untrack(self, name):
         del self._registry[name]
-        self._save_registry()
+        self._append_journal(self._journal_delete(name))
 
     def get_saves_list(self):
         return list(self._registry.values())
@@ -103,13 +178,13 @@ class Local:
 
     def _get_last_mod_time(self, save):
         latest_ts = 0
-        for file in self._get_save_files(save):
-            mtime_ts = file.stat().st_mtime
+        for entry, _ in self._get_save_files(save):
+            mtime_ts = entry.stat().st_mtime
             if mtime_ts > latest_ts:
                 latest_ts = mtime_ts
         if latest_ts == 0:
             return None
-        return datetime.fromtimestamp(latest_ts)
+        return latest_ts
 
     def _get_save_files(self, save):
         include = []
@@ -120,27 +195,35 @@ class Local:
                 _filter = _filter[1:]
                 neg = True
             _filter = os.path.join(*re.split(r"\\|/", _filter))
-            _filter = ".*?".join(re.escape(s) for s in _filter.split('*'))
+            _filter = re.compile(".*?".join(re.escape(s) for s in _filter.split('*')))
             if neg:
                 ignore.append(_filter)
             else:
                 include.append(_filter)
-        root = Path(save['root'])
-        for file in root.glob('**/*'):
-            if not file.is_file():
-                continue
-            relative_name = str(file.relative_to(root))
-            if not all(re.fullmatch(f, relative_name) for f in include):
-                continue
-            if any(re.fullmatch(f, relative_name) for f in ignore):
-                continue
-            yield file
+        root = save['root']
+        if not os.path.isdir(root):
+            return
+        folders = [root]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    relative_name = os.path.relpath(entry.path, root)
+                    if not all(f.fullmatch(relative_name) for f in include):
+                        continue
+                    if any(f.fullmatch(relative_name) for f in ignore):
+                        continue
+                    yield entry, relative_name
 
     def pack_save_files(self, save_name, output_file):
         save = self._registry[save_name]
-        with ZipFile(output_file, 'w') as zf:
-            for file in self._get_save_files(save):
-                zf.write(file, file.relative_to(save['root']))
+        with ZipFile(output_file, 'w', ZIP_DEFLATED, compresslevel=ARCHIVE_COMPRESSLEVEL) as zf:
+            for entry, relative_name in self._get_save_files(save):
+                zf.write(entry.path, relative_name)
 
     def unpack_save_files(self, save_name, filepath):
         save = self._registry[save_name]
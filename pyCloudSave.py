@@ -4,7 +4,8 @@ import argparse
 import json
 import os
 import sys
-from datetime import MINYEAR, datetime
+import time
+from datetime import datetime
 from numbers import Real
 from pathlib import Path
 from typing import Any, Union
@@ -13,15 +14,15 @@ from tabulate import tabulate
 
 from common import AppError, normalize_name, normalized_search, SaveNotFoundError, MultipleSavesFoundError
 from local import Local
-from remote import GDriveFS, Remote, FilebasedRemote, LocalFS
+from remote import GDriveFS, Remote, FilebasedRemote, LocalFS, SQLiteFilebasedRemote, TransferError
 
+APP_ROOT = Path(__file__).resolve().parent
 DATETIME_PRINT_FORMAT = "%d.%m.%y %H:%M:%S"
-MIN_DATE = datetime(MINYEAR, 1, 1)
 
-def datetime_to_str(obj: Union[datetime, Any], default='-'):
-    if not isinstance(obj, datetime):
+def timestamp_to_str(obj: Union[Real, Any], default='-'):
+    if not isinstance(obj, Real):
         return default
-    return datetime.strftime(obj, DATETIME_PRINT_FORMAT)
+    return datetime.fromtimestamp(obj).strftime(DATETIME_PRINT_FORMAT)
 
 def size_to_str(obj: Union[Real, Any], default='-'):
     if not isinstance(obj, Real):
@@ -34,13 +35,26 @@ def size_to_str(obj: Union[Real, Any], default='-'):
     return f"{obj:.1f} Tb"
         
 class Application:
-    def __init__(self, remote: Remote, local_registry=None):
+    _parser = None
+
+    # local_registry is a path to the registry file or a storage object, see Local
+    def __init__(self, remote: Remote, local_registry=None, temp_folder=None):
         self.remote = remote
         self.local = Local(local_registry)
-        self.temp_folder = Path(__file__).parent.joinpath('temp')
-        self.temp_folder.mkdir(exist_ok=True)
-
-    def parse_args(self, argv):
+        if temp_folder is None:
+            temp_folder = APP_ROOT / 'temp'
+        self.temp_folder = Path(temp_folder)
+
+    @classmethod
+    def _get_parser(cls):
+        if cls._parser is None:
+            cls._parser = cls._build_parser()
+        return cls._parser
+
+    @staticmethod
+    def _build_parser():
+        # Commands are stored as method names and resolved on the instance,
+        # so the parser can be built once and shared.
         parser = argparse.ArgumentParser()
         subparsers = parser.add_subparsers(required=True)
 
@@ -48,66 +62,67 @@ class Application:
         name_parser.add_argument('name', nargs='+')
 
         list_parser = subparsers.add_parser('list')
-        list_parser.set_defaults(command=self.command_list)
+        list_parser.set_defaults(command='command_list')
 
         show_parser = subparsers.add_parser('show', parents=[name_parser])
-        show_parser.set_defaults(command=self.command_show)
+        show_parser.set_defaults(command='command_show')
 
         track_parser = subparsers.add_parser('track', aliases=['add'], parents=[name_parser])
         track_parser.add_argument('--root', '-r')
         track_parser.add_argument('--filters', '-f')
         track_parser.add_argument('--version', '-v')
-        track_parser.add_argument('--copy', '-c', action='store_const', const=self.command_copy, dest='command')
-        track_parser.set_defaults(command=self.command_track)
+        track_parser.add_argument('--copy', '-c', action='store_const', const='command_copy', dest='command')
+        track_parser.set_defaults(command='command_track')
 
         edit_parser = subparsers.add_parser('edit', parents=[name_parser])
         edit_parser.add_argument('--new_name', '--name', '-n')
         edit_parser.add_argument('--root', '-r')
         edit_parser.add_argument('--filters', '-f')
         edit_parser.add_argument('--version', '-v')
-        edit_parser.set_defaults(command=self.command_edit)
+        edit_parser.set_defaults(command='command_edit')
 
         untrack_parser = subparsers.add_parser('untrack', aliases=['remove'], parents=[name_parser])
-        untrack_parser.set_defaults(command=self.command_untrack)
+        untrack_parser.set_defaults(command='command_untrack')
 
         load_parser = subparsers.add_parser('load', parents=[name_parser])
-        load_parser.set_defaults(command=self.command_load)
+        load_parser.set_defaults(command='command_load')
 
         upload_parser = subparsers.add_parser('upload', parents=[name_parser])
-        upload_parser.set_defaults(command=self.command_upload)
+        upload_parser.set_defaults(command='command_upload')
 
         sync_parser = subparsers.add_parser('sync')
         sync_parser.add_argument('name', nargs='*')
         sync_parser.add_argument('--all', '-a', action='store_true')
-        sync_parser.set_defaults(command=self.command_sync)
+        sync_parser.set_defaults(command='command_sync')
 
         remote_parser = subparsers.add_parser('remote')
         remote_subparsers = remote_parser.add_subparsers(required=True)
 
         remote_list_parser = remote_subparsers.add_parser('list')
-        remote_list_parser.set_defaults(command=self.command_remote_list)
+        remote_list_parser.set_defaults(command='command_remote_list')
 
         remote_show_parser = remote_subparsers.add_parser('show', parents=[name_parser])
-        remote_show_parser.set_defaults(command=self.command_remote_show)
+        remote_show_parser.set_defaults(command='command_remote_show')
 
         remote_edit_parser = remote_subparsers.add_parser('edit', parents=[name_parser])
         remote_edit_parser.add_argument('--new_name', '--name', '-n')
         remote_edit_parser.add_argument('--version', '-v')
         remote_edit_parser.add_argument('--root', '-r')
         remote_edit_parser.add_argument('--filters', '-f')
-        remote_edit_parser.set_defaults(command=self.command_remote_edit)
+        remote_edit_parser.set_defaults(command='command_remote_edit')
 
         remote_delete_parser = remote_subparsers.add_parser('delete', parents=[name_parser])
-        remote_delete_parser.set_defaults(command=self.command_remote_delete)
+        remote_delete_parser.set_defaults(command='command_remote_delete')
+
+        return parser
 
+    def parse_args(self, argv):
+        parser = self._get_parser()
         args = parser.parse_args(argv)
         if 'name' in args:
-            if len(args.name) > 1:
-                args.name = ' '.join(args.name)
-            else:
-                args.name = args.name[0]
+            args.name = ' '.join(args.name)
         try:
-            args.command(args)
+            getattr(self, args.command)(args)
         except AppError as err:
             print(err.message)
 
@@ -122,9 +137,9 @@ class Application:
             rs = self.remote.get_save(ls['id_name']) or {}
             data.append([
                 ls['name'],
-                datetime_to_str(ls.get('last_modification')),
-                datetime_to_str(ls.get('last_sync')),
-                datetime_to_str(rs.get('last_upload')),
+                timestamp_to_str(ls.get('last_modification')),
+                timestamp_to_str(ls.get('last_sync')),
+                timestamp_to_str(rs.get('last_upload')),
                 size_to_str(rs.get('size'))
             ])
         print(tabulate(data, headers, tablefmt='github'))
@@ -137,13 +152,13 @@ class Application:
         print(f"Root folder: {save['root']}")
         if save['filters']:
             print(f"Filters: {save['filters']}")
-        print(f"Last modification: {datetime_to_str(save['last_modification'])}")
-        print(f"Last sync: {datetime_to_str(save['last_sync'])}")
+        print(f"Last modification: {timestamp_to_str(save['last_modification'])}")
+        print(f"Last sync: {timestamp_to_str(save['last_sync'])}")
         remote_save = self.remote.get_registry().get(save['id_name'])
         if not remote_save:
             return
-        print(f"Remote last upload: {datetime_to_str(remote_save['last_upload'])}")
-        print(f"Remote size: {size_to_str(remote_save['size'])}")
+        print(f"Remote last upload: {timestamp_to_str(remote_save['last_upload'])}")
+        print(f"Remote size: {size_to_str(remote_save.get('size'))}")
 
     def command_track(self, args):
         print(f"Adding new save to local registry: {args.name}")
@@ -215,52 +230,91 @@ class Application:
 
     def command_sync(self, args):
         if args.all:
-            for save_id in self.local.get_registry().keys():
-                self._sync(save_id)
+            # Fetch remote state once for the whole run instead of once per save
+            remote_registry = self.remote.get_registry()
+            save_ids = list(self.local.get_registry().keys())
         else:
             if not args.name:
                 raise AppError("Save name not specified.")
             save = self.local.find_save(args.name)
-            self._sync(save['id_name'])
-
-    def _sync(self, id_name):
-        local_save = self.local.get_save(id_name)
-        remote_updated = self.is_remote_updated(id_name)
-        local_updated = self.is_local_updated(id_name)
-        if remote_updated and local_updated:
-            print(f"Save files for {local_save['name']} are out of sync, some data can be lost! Please load or upload explicitly.")
-        elif local_updated:
-            self._upload(local_save['id_name'])
-        elif remote_updated:
-            self._load(local_save['id_name'])
-
-    def _upload(self, id_name):
-        local_save = self.local.get_save(id_name)
-        print(f"Uploading save {local_save['name']}")
-        remote_save = self.remote.get_save(id_name)
-        if not remote_save:
-            self.remote.register_new_save(local_save['name'], local_save['root'], local_save['filters'], local_save['version'])
-        tmp_file = self.temp_folder.joinpath(id_name)
-        print("Packing files...")
-        self.local.pack_save_files(id_name, tmp_file)
-        _datetime = datetime.now()
-        print("Uploading...")
-        self.remote.upload_save(id_name, tmp_file, _datetime)
-        self.local.edit(id_name, last_sync=_datetime)
-        tmp_file.unlink()
-        print(f"Save {local_save['name']} uploaded.")
-
-    def _load(self, id_name):
-        local_save = self.local.get_save(id_name)
-        print(f"Loading save {local_save['name']}")
-        tmp_file = self.temp_folder.joinpath(id_name)
+            save_ids = [save['id_name']]
+            remote_registry = {save['id_name']: self.remote.get_save(save['id_name'])}
+        to_upload = []
+        to_load = []
+        for save_id in save_ids:
+            local_save = self.local.get_save(save_id)
+            local_updated = self.is_local_updated(save_id)
+            remote_updated = self._is_upload_newer(remote_registry.get(save_id), local_save)
+            if remote_updated and local_updated:
+                print(f"Save files for {local_save['name']} are out of sync, some data can be lost! Please load or upload explicitly.")
+            elif local_updated:
+                to_upload.append(save_id)
+            elif remote_updated:
+                to_load.append(save_id)
+        # Transfers are done together, so the remote can run them in parallel and update its registry once
+        if to_upload:
+            self._upload(*to_upload)
+        if to_load:
+            self._load(*to_load)
+
+    def _upload(self, *id_names):
+        uploads = []
+        with self.remote.batch():
+            for id_name in id_names:
+                local_save = self.local.get_save(id_name)
+                print(f"Uploading save {local_save['name']}")
+                if not self.remote.get_save(id_name):
+                    self.remote.register_new_save(local_save['name'], local_save['root'], local_save['filters'], local_save['version'])
+                tmp_file = self._get_temp_file(id_name)
+                print("Packing files...")
+                self.local.pack_save_files(id_name, tmp_file)
+                uploads.append((id_name, tmp_file))
+            timestamp = time.time()
+            print("Uploading...")
+            failed = {}
+            try:
+                self.remote.upload_saves([(id_name, tmp_file, timestamp) for id_name, tmp_file in uploads])
+            except TransferError as err:
+                failed = err.errors
+                error = err
+        for id_name, tmp_file in uploads:
+            tmp_file.unlink()
+            if id_name in failed:
+                continue
+            self.local.edit(id_name, last_sync=timestamp)
+            print(f"Save {self.local.get_save(id_name)['name']} uploaded.")
+        if failed:
+            raise error
+
+    def _load(self, *id_names):
+        loads = []
+        for id_name in id_names:
+            print(f"Loading save {self.local.get_save(id_name)['name']}")
+            loads.append((id_name, self._get_temp_file(id_name)))
         print("Downloading...")
-        self.remote.load_save(id_name, tmp_file)
-        print("Unpacking...")
-        self.local.unpack_save_files(id_name, tmp_file)
-        self.local.edit(id_name, last_sync=datetime.now())
-        tmp_file.unlink()
-        print(f"Save {local_save['name']} loaded.")
+        failed = {}
+        try:
+            self.remote.load_saves(loads)
+        except TransferError as err:
+            failed = err.errors
+            error = err
+        for id_name, tmp_file in loads:
+            if id_name in failed:
+                tmp_file.unlink(missing_ok=True)
+                continue
+            print("Unpacking...")
+            self.local.unpack_save_files(id_name, tmp_file)
+            self.local.edit(id_name, last_sync=time.time())
+            tmp_file.unlink()
+            print(f"Save {self.local.get_save(id_name)['name']} loaded.")
+        if failed:
+            raise error
+
+    def _get_temp_file(self, id_name):
+        # Only commands that actually transfer files need the temp folder
+        if not self.temp_folder.exists():
+            self.temp_folder.mkdir()
+        return self.temp_folder / id_name
 
     def command_remote_list(self, _):
         saves = self.remote.get_saves_list()
@@ -269,7 +323,7 @@ class Application:
             return
         headers = ['Save name', 'Last upload', 'Size']
         data = [
-            [s['name'], datetime_to_str(s['last_upload']), size_to_str(s['size'])]
+            [s['name'], timestamp_to_str(s['last_upload']), size_to_str(s.get('size'))]
             for s in saves
         ]
         print(tabulate(data, headers, tablefmt='github'))
@@ -279,8 +333,8 @@ class Application:
         print(f"Game name: {save['name']}")
         if save['version']:
             print(f"Game version: {save['version']}")
-        print(f"Last upload: {datetime_to_str(save['last_upload'])}")
-        print(f"Size: {size_to_str(save['size'])}")
+        print(f"Last upload: {timestamp_to_str(save['last_upload'])}")
+        print(f"Size: {size_to_str(save.get('size'))}")
         if save['root_hint']:
             print(f"Root hint: {save['root_hint']}")
         if save['filters_hint']:
@@ -296,25 +350,27 @@ class Application:
         print(f"Save {save['name']} succesfully deleted.")
 
     def is_remote_updated(self, id_name):
-        local_save = self.local.get_save(id_name)
-        remote_save = self.remote.get_save(id_name)
-        remote_last_upload = remote_save['last_upload'] if (remote_save and remote_save['last_upload']) else MIN_DATE
-        local_last_sync = local_save['last_sync'] or MIN_DATE
+        return self._is_upload_newer(self.remote.get_save(id_name), self.local.get_save(id_name))
+
+    @staticmethod
+    def _is_upload_newer(remote_save, local_save):
+        remote_last_upload = remote_save['last_upload'] if (remote_save and remote_save['last_upload']) else 0.0
+        local_last_sync = local_save['last_sync'] or 0.0
         return remote_last_upload > local_last_sync
     
     def is_local_updated(self, id_name):
         local_save = self.local.get_save(id_name)
-        local_last_sync = local_save['last_sync'] or MIN_DATE
-        local_last_modification = local_save['last_modification'] or MIN_DATE
+        local_last_sync = local_save['last_sync'] or 0.0
+        local_last_modification = local_save['last_modification'] or 0.0
         return local_last_modification > local_last_sync
     
     def show_dates_comparison(self, id_name):
         local_save = self.local.get_save(id_name)
         remote_save = self.remote.get_save(id_name)
         data = [[
-            datetime_to_str(local_save['last_modification']),
-            datetime_to_str(local_save.get('last_sync')),
-            datetime_to_str(remote_save['last_upload'])
+            timestamp_to_str(local_save['last_modification']),
+            timestamp_to_str(local_save.get('last_sync')),
+            timestamp_to_str(remote_save['last_upload'])
         ]]
         headers=['Local modified', 'Local synced', 'Remote uploaded']
         print(tabulate(data, headers, tablefmt='github'))
@@ -352,14 +408,17 @@ class YesNoAsker:
 
 def create_remote(options):
     if options['type'] == 'localfs':
-        return FilebasedRemote(LocalFS(options['folder']))
+        fs = LocalFS(options['folder'])
     elif options['type'] == 'gdrive':
-        return FilebasedRemote(GDriveFS("pyCloudSave"))
+        fs = GDriveFS("pyCloudSave", max_transfers=options.get('max_transfers', 4))
     else:
         raise ValueError("Remote is incorrect")
+    if options.get('registry') == 'sqlite':
+        return SQLiteFilebasedRemote(fs)
+    return FilebasedRemote(fs)
 
 if __name__ == "__main__":
-    os.chdir(Path(__file__).parent)
+    os.chdir(APP_ROOT)
     with open('remote_options.json') as fio:
         remote_options = json.load(fio)
     remote = create_remote(remote_options)
@@ -1,19 +1,34 @@
+import gzip
+import hashlib
 import json
+import os
 import shutil
-from datetime import datetime
+import sqlite3
+import tempfile
+import time
+from functools import lru_cache
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from pathlib import Path
-from typing import Any, Union
+from typing import Any, Optional, Union
 from pydrive.auth import GoogleAuth, RefreshError
 from pydrive.drive import GoogleDrive
-from pydrive.files import GoogleDriveFile
+from pydrive.files import ApiRequestError, GoogleDriveFile
 
-from common import AppError, SaveNotFoundError, MultipleSavesFoundError, normalize_name, json_default, DATETIME_FORMAT, normalized_search
+from common import AppError, SaveNotFoundError, MultipleSavesFoundError, normalize_name, json_dumps, json_loads, load_timestamp, normalized_search
 
-REMOTE_REGISTRY_VERSION = "1.0"
+REMOTE_REGISTRY_VERSION = "1.1"
+# 1.0 stored timestamps as formatted strings, 1.1 stores them as POSIX floats
+LEGACY_REMOTE_REGISTRY_VERSIONS = ("1.0",)
 
 class Remote(ABC):
 
+    @contextmanager
+    def batch(self):
+        # Groups several changes so a remote can apply them together
+        yield
+
     @abstractmethod
     def register_new_save(self, name, root_hint=None, filters_hint=None, version=None):
         pass
@@ -30,6 +45,27 @@ class Remote(ABC):
     def load_save(self, id_name, output_file):
         pass
 
+    # Group transfers go on past a failed save and raise TransferError for the failed ones at the end
+    def upload_saves(self, uploads):
+        errors = {}
+        for id_name, file_to_upload, timestamp in uploads:
+            try:
+                self.upload_save(id_name, file_to_upload, timestamp)
+            except Exception as err:
+                errors[id_name] = err
+        if errors:
+            raise TransferError(errors)
+
+    def load_saves(self, loads):
+        errors = {}
+        for id_name, output_file in loads:
+            try:
+                self.load_save(id_name, output_file)
+            except Exception as err:
+                errors[id_name] = err
+        if errors:
+            raise TransferError(errors)
+
     @abstractmethod
     def delete_save(self, id_name):
         pass
@@ -55,7 +91,21 @@ class FileDoesNotExistError(RemoteFSError):
 class RemoteAccessError(RemoteFSError):
     pass
 
+class TransferError(AppError):
+    def __init__(self, errors: dict[str, Exception]):
+        # Saves that failed, by id_name, the rest of the group went through
+        self.errors = errors
+        messages = []
+        for id_name, error in errors.items():
+            if isinstance(error, FileDoesNotExistError):
+                messages.append(f"Save {id_name} is not present in remote.")
+            else:
+                messages.append(f"Transfer of save {id_name} failed: {error}")
+        super().__init__("\n".join(messages))
+
 class RemoteFS(ABC):
+    # JSON files are only meant to be reached through load_json/upload_json, GDriveFS stores them
+    # gzipped as <name>.gz, so load_file/rename_file/delete_file won't find them under <name>
     def load_json(self, filename) -> dict[str, Any]:
         pass
 
@@ -74,27 +124,67 @@ class RemoteFS(ABC):
     def delete_file(self, filename):
         pass
 
+    # Both return the error raised for each file, or None for the files that were transferred
+    def load_files(self, files) -> list[Optional[Exception]]:
+        return [self._try_transfer(self.load_file, filename, target) for filename, target in files]
+
+    def upload_files(self, files) -> list[Optional[Exception]]:
+        return [self._try_transfer(self.upload_file, filename, source) for filename, source in files]
+
+    @staticmethod
+    def _try_transfer(func, *args):
+        try:
+            func(*args)
+        except Exception as err:
+            return err
+        return None
+
 REGISTRY_FILENAME = "registry.json"
 class FilebasedRemote(Remote):
     def __init__(self, fs: RemoteFS):
         self.fs = fs
         self._registry = None
+        self._batch_depth = 0
+        self._registry_changed = False
+
+    @contextmanager
+    def batch(self):
+        # Registry is uploaded once when the outermost batch ends instead of after every change
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._registry_changed:
+                self._upload_registry()
     
     def get_registry(self) -> dict[str, dict[str, Any]]:
         if self._registry is not None:
             return self._registry
+        registry, legacy = self._load_json_registry()
+        if legacy:
+            # Converted once, so later loads skip parsing the timestamps
+            self._save_registry(registry)
+        self._registry = registry
+        return registry
+
+    def _load_json_registry(self) -> tuple[dict[str, dict[str, Any]], bool]:
+        # Also returns whether the registry was converted from a legacy version
         try:
             data = self.fs.load_json(REGISTRY_FILENAME)
-            if data['version'] != REMOTE_REGISTRY_VERSION:
-                raise ValueError(f"Remote registry version: {data['version']} is not supported.")
-            registry = data['saves']
-            for id_name, save in registry.items():
-                save['last_upload'] = datetime.strptime(save['last_upload'], DATETIME_FORMAT)
-                save['id_name'] = id_name
         except FileDoesNotExistError:
-            registry = {}
-        self._registry = registry
-        return registry
+            return {}, False
+        if data['version'] == SQLITE_MOVED_REGISTRY_VERSION:
+            raise AppError(f'Remote registry was moved into {SQLITE_REGISTRY_FILENAME}, set the remote option registry to "sqlite" to use it.')
+        legacy = data['version'] in LEGACY_REMOTE_REGISTRY_VERSIONS
+        if data['version'] != REMOTE_REGISTRY_VERSION and not legacy:
+            raise ValueError(f"Remote registry version: {data['version']} is not supported.")
+        registry = data['saves']
+        for id_name, save in registry.items():
+            if legacy and save['last_upload']:
+                save['last_upload'] = load_timestamp(save['last_upload'])
+            save['id_name'] = id_name
+        return registry, legacy
     
     def register_new_save(self, name, root_hint=None, filters_hint=None, version=None):
         registry = self.get_registry()
@@ -129,18 +219,32 @@ class FilebasedRemote(Remote):
         self._save_registry(registry)
 
     def load_save(self, id_name, output_file):
-        try:
-            self.fs.load_file(self._get_filesave_name(id_name), output_file)
-        except FileDoesNotExistError:
-            raise KeyError(f"Save {id_name} is not present in remote.") from None
+        self.load_saves([(id_name, output_file)])
+
+    def load_saves(self, loads):
+        results = self.fs.load_files([(self._get_filesave_name(id_name), output_file) for id_name, output_file in loads])
+        errors = {id_name: error for (id_name, _), error in zip(loads, results) if error is not None}
+        if errors:
+            raise TransferError(errors)
 
-    def upload_save(self, id_name, file_to_upload, _datetime):
+    def upload_save(self, id_name, file_to_upload, timestamp):
+        self.upload_saves([(id_name, file_to_upload, timestamp)])
+
+    def upload_saves(self, uploads):
         registry = self.get_registry()
-        save = registry[id_name]
-        self.fs.upload_file(self._get_filesave_name(id_name), file_to_upload)
-        save['last_upload'] = _datetime
-        save['size'] = Path(file_to_upload).stat().st_size
+        results = self.fs.upload_files([(self._get_filesave_name(id_name), file_to_upload) for id_name, file_to_upload, _ in uploads])
+        errors = {}
+        for (id_name, file_to_upload, timestamp), error in zip(uploads, results):
+            if error is not None:
+                errors[id_name] = error
+                continue
+            # Remote file is already replaced, so it's recorded even when other saves failed
+            save = registry[id_name]
+            save['last_upload'] = timestamp
+            save['size'] = Path(file_to_upload).stat().st_size
         self._save_registry(registry)
+        if errors:
+            raise TransferError(errors)
 
     def delete_save(self, id_name):
         registry = self.get_registry()
@@ -150,7 +254,19 @@ class FilebasedRemote(Remote):
 
     def _save_registry(self, changed_registry):
         self._registry = changed_registry
-        data = {'version': REMOTE_REGISTRY_VERSION, 'saves': changed_registry}
+        if self._batch_depth:
+            self._registry_changed = True
+            return
+        self._upload_registry()
+
+    def _upload_registry(self):
+        self._registry_changed = False
+        # id_name is the key of each save, so it is restored on load instead of being stored twice
+        saves = {
+            id_name: {k: v for k, v in save.items() if k != 'id_name'}
+            for id_name, save in self._registry.items()
+        }
+        data = {'version': REMOTE_REGISTRY_VERSION, 'saves': saves}
         self.fs.upload_json(REGISTRY_FILENAME, data)
 
     def _get_filesave_name(self, id_name):
@@ -171,69 +287,330 @@ class FilebasedRemote(Remote):
             raise MultipleSavesFoundError(search_name, [registry[s]['name'] for s in results])
         return registry[results[0]]
 
+SQLITE_REGISTRY_FILENAME = "registry.db"
+SQLITE_REGISTRY_VERSION = 1
+SQLITE_SAVE_COLUMNS = ('name', 'root_hint', 'filters_hint', 'version', 'last_upload', 'size')
+# Written over the json registry once it is carried over, so json remotes stop using the stale copy
+SQLITE_MOVED_REGISTRY_VERSION = "sqlite"
+
+class SQLiteFilebasedRemote(FilebasedRemote):
+    # Registry is kept in a sqlite database, only the rows that changed are rewritten
+    # and the database file is then synced to the fs
+    def __init__(self, fs: RemoteFS, db_file=None):
+        super().__init__(fs)
+        if db_file is None:
+            # Database is downloaded again for every session, so each remote gets its own temporary copy
+            self._temp_dir = tempfile.TemporaryDirectory()
+            db_file = Path(self._temp_dir.name, SQLITE_REGISTRY_FILENAME)
+        self.db_file = Path(db_file)
+        self._written_rows = {}
+        self._carrying_over = False
+
+    def get_registry(self) -> dict[str, dict[str, Any]]:
+        if self._registry is not None:
+            return self._registry
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.fs.load_file(SQLITE_REGISTRY_FILENAME, self.db_file)
+        except FileDoesNotExistError:
+            # Remote without a database yet, an existing json registry is carried over
+            self.db_file.unlink(missing_ok=True)
+            registry, _ = self._load_json_registry()
+            self._registry = registry
+            if registry:
+                self._carrying_over = True
+                self._save_registry(registry)
+            return registry
+        with closing(sqlite3.connect(self.db_file)) as db:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SQLITE_REGISTRY_VERSION:
+                raise ValueError(f"Remote registry version: {version} is not supported.")
+            rows = db.execute(f"SELECT id_name, {', '.join(SQLITE_SAVE_COLUMNS)} FROM saves").fetchall()
+        registry = {}
+        for id_name, *values in rows:
+            self._written_rows[id_name] = tuple(values)
+            registry[id_name] = dict(zip(SQLITE_SAVE_COLUMNS, values), id_name=id_name)
+        self._registry = registry
+        return registry
+
+    def _upload_registry(self):
+        self._registry_changed = False
+        rows = {
+            id_name: tuple(save.get(column) for column in SQLITE_SAVE_COLUMNS)
+            for id_name, save in self._registry.items()
+        }
+        removed = [(id_name,) for id_name in self._written_rows if id_name not in rows]
+        changed = [(id_name, *row) for id_name, row in rows.items() if self._written_rows.get(id_name) != row]
+        with closing(sqlite3.connect(self.db_file)) as db, db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS saves (id_name TEXT PRIMARY KEY, name TEXT, root_hint TEXT, "
+                "filters_hint TEXT, version TEXT, last_upload REAL, size INTEGER)"
+            )
+            db.execute(f"PRAGMA user_version = {SQLITE_REGISTRY_VERSION}")
+            db.executemany("DELETE FROM saves WHERE id_name = ?", removed)
+            db.executemany(f"INSERT OR REPLACE INTO saves VALUES (?{', ?' * len(SQLITE_SAVE_COLUMNS)})", changed)
+        self._written_rows = rows
+        self.fs.upload_file(SQLITE_REGISTRY_FILENAME, self.db_file)
+        if self._carrying_over:
+            # Only once the database is uploaded, a failed upload leaves the json registry in use
+            self.fs.upload_json(REGISTRY_FILENAME, {'version': SQLITE_MOVED_REGISTRY_VERSION, 'saves': {}})
+            self._carrying_over = False
+
 class LocalFS(RemoteFS):
     def __init__(self, root_folder):
         self.root_folder = Path(root_folder)
         self.root_folder.mkdir(exist_ok=True)
     
+    # Missing files are detected from the failed operation itself rather than
+    # with a separate is_file() check, saving a stat call per operation
     def load_json(self, filename) -> dict[str, Any]:
-        file = self.root_folder.joinpath(filename)
-        if not file.is_file():
-            raise FileDoesNotExistError()
-        with open(file, "r") as fio:
-            return json.load(fio)
+        try:
+            fio = open(self.root_folder.joinpath(filename), "rb")
+        except FileNotFoundError:
+            raise FileDoesNotExistError() from None
+        with fio:
+            return json_loads(fio.read())
 
     def upload_json(self, filename, data):
-        with open(self.root_folder.joinpath(filename), "w") as fio:
-            return json.dump(data, fio, default=json_default)
+        # Written next to the target and swapped in, so a failed write never leaves a truncated file behind
+        file = self.root_folder.joinpath(filename)
+        temp_file = file.with_name(file.name + '.tmp')
+        with open(temp_file, "wb") as fio:
+            fio.write(json_dumps(data))
+        os.replace(temp_file, file)
 
     def load_file(self, filename, target):
         file = self.root_folder.joinpath(filename)
-        if not file.is_file():
-            raise FileDoesNotExistError()
-        shutil.copy(file, target)
+        try:
+            copy_file(file, target)
+        except FileNotFoundError as err:
+            if err.filename != str(file):
+                raise
+            raise FileDoesNotExistError() from None
 
     def upload_file(self, filename, source):
-        shutil.copy(source, self.root_folder.joinpath(filename))
+        copy_file(source, self.root_folder.joinpath(filename))
 
     def rename_file(self, filename, new_filename):
-        self.root_folder.joinpath(filename).rename(self.root_folder.joinpath(new_filename))
+        try:
+            self.root_folder.joinpath(filename).rename(self.root_folder.joinpath(new_filename))
+        except FileNotFoundError:
+            raise FileDoesNotExistError() from None
 
     def delete_file(self, filename):
-        self.root_folder.joinpath(filename).unlink()
+        try:
+            self.root_folder.joinpath(filename).unlink()
+        except FileNotFoundError:
+            raise FileDoesNotExistError() from None
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def copy_file(source, target):
+    # Filesystems with copy-on-write support (btrfs, xfs) clone the data on copy_file_range instead of copying it
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(source, target)
+        return
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError:
+            # Not supported between these files, copy them the usual way
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
 
 FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+GZIP_MIME_TYPE = 'application/gzip'
+DRIVE_IDS_FILE = Path(__file__).parent.joinpath('drive_ids.json')
+CACHE_FOLDER = Path(__file__).parent.joinpath('cache')
+# Seconds a looked up Drive file is reused before it is queried again
+FILE_CACHE_TTL = 60
+# Only the file fields used here are requested, listings return far more by default
+FILE_FIELDS = 'items(id,title,mimeType,downloadUrl,md5Checksum,fileSize,modifiedDate)'
+
+@lru_cache(maxsize=256)
+def build_query(metadata_items, parent_id):
+    clauses = ["trashed = false"]
+    for name, value in metadata_items:
+        clauses.append(f"{name} = '{value}'")
+    if parent_id:
+        clauses.append(f"'{parent_id}' in parents")
+    else:
+        clauses.append("'root' in parents")
+    return " and ".join(clauses)
 
 class GDriveFS(RemoteFS):
-    def __init__(self, root_folder, settings_file='settings.yaml') -> None:
+    # Authenticated drives shared by all instances in the process, by settings file
+    _drives: dict[str, GoogleDrive] = {}
+
+    def __init__(self, root_folder, settings_file='settings.yaml', max_transfers=4) -> None:
         self.root_folder = root_folder
+        self.settings_file = settings_file
+        self.max_transfers = max_transfers
         self.root_folder_id = None
         self.drive = None
         self._registry = None
+        self._root_folder_verified = False
+        self._root_folder_created = False
+        self._file_cache: dict[tuple, tuple[float, GoogleDriveFile]] = {}
+        self._uncompressed_files = set()
+        self._file_ids: Optional[dict[str, str]] = None
 
     def _init_drive(self):
         if self.drive is not None:
             return
+        self.drive = self._get_drive(self.settings_file)
+        # Folder id is stable, so it is cached between runs to skip a lookup
+        self.root_folder_id = self._load_file_ids().get(self.root_folder)
+        if self.root_folder_id is None:
+            self._resolve_root_folder()
+
+    @classmethod
+    def _get_drive(cls, settings_file):
+        if settings_file in cls._drives:
+            return cls._drives[settings_file]
         try:
-            gauth = GoogleAuth()
+            gauth = GoogleAuth(settings_file)
             gauth.LocalWebserverAuth()
         except RefreshError:
             Path(__file__).parent.joinpath('credentials.json').unlink()
-            gauth = GoogleAuth()
+            DRIVE_IDS_FILE.unlink(missing_ok=True)
+            gauth = GoogleAuth(settings_file)
             gauth.LocalWebserverAuth()
-        self.drive = GoogleDrive(gauth)
-        self.root_folder_id = self._get_or_create_file({'title': self.root_folder, 'mimeType': FOLDER_MIME_TYPE})['id']
+        drive = GoogleDrive(gauth)
+        cls._drives[settings_file] = drive
+        return drive
+
+    def _resolve_root_folder(self):
+        metadata = {'title': self.root_folder, 'mimeType': FOLDER_MIME_TYPE}
+        try:
+            self.root_folder_id = self._get_file(metadata)['id']
+        except FileDoesNotExistError:
+            self.root_folder_id = self._create_file(metadata)['id']
+            self._root_folder_created = True
+        self._root_folder_verified = True
+        self._store_file_id(self.root_folder, self.root_folder_id)
+
+    def _load_file_ids(self) -> dict[str, str]:
+        # Read once per instance, this instance is the one keeping the file up to date
+        if self._file_ids is None:
+            try:
+                with open(DRIVE_IDS_FILE) as fio:
+                    self._file_ids = json.load(fio)
+            except (FileNotFoundError, ValueError):
+                self._file_ids = {}
+        return self._file_ids
+
+    def _store_file_id(self, name, file_id):
+        file_ids = self._load_file_ids()
+        if file_ids.get(name) == file_id:
+            return
+        if file_id is None:
+            file_ids.pop(name, None)
+        else:
+            file_ids[name] = file_id
+        with open(DRIVE_IDS_FILE, 'w') as fio:
+            json.dump(file_ids, fio)
+
+    def _get_file_id_name(self, filename):
+        return f"{self.root_folder}/{filename}"
+
+    def _check_root_folder(self):
+        # Returns True if the cached id was stale and the folder had to be resolved again
+        self._root_folder_verified = True
+        try:
+            folder = self.drive.CreateFile({'id': self.root_folder_id})
+            folder.FetchMetadata(fields='trashed')
+            if not folder['trashed']:
+                return False
+        except ApiRequestError:
+            pass
+        self._resolve_root_folder()
+        return True
 
+    # Json files are stored gzipped on the drive, they compress several times over
     def load_json(self, filename) -> dict[str, Any]:
         self._init_drive()
-        file = self._get_file({'title': filename}, self.root_folder_id)
-        return json.loads(file.GetContentString())
+        try:
+            content = self._load_content(filename + '.gz')
+        except FileDoesNotExistError:
+            # Files uploaded before compression, replaced on the next upload
+            content = self._load_content(filename)
+            self._uncompressed_files.add(filename)
+            return json_loads(content)
+        return json_loads(gzip.decompress(content))
+
+    def _load_content(self, filename):
+        try:
+            file = self._get_file({'title': filename}, self.root_folder_id)
+        except FileDoesNotExistError:
+            self._store_file_id(self._get_file_id_name(filename), None)
+            raise
+        self._store_file_id(self._get_file_id_name(filename), file['id'])
+        # Listing already returns the checksum, so an unchanged file is read from the local cache without downloading
+        content = self._load_cached(filename, file.get('md5Checksum'))
+        if content is None:
+            cache_file = self._get_cache_file(filename)
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            file.GetContentFile(str(cache_file))
+            content = cache_file.read_bytes()
+        return content
 
     def upload_json(self, filename, data):
         self._init_drive()
-        file = self._get_or_create_file({'title': filename}, self.root_folder_id)
-        file.SetContentString(json.dumps(data, default=json_default))
-        file.Upload()
+        compressed_filename = filename + '.gz'
+        # Content is uploaded from the cache file, pydrive only takes string content as text
+        self._store_cached(compressed_filename, gzip.compress(json_dumps(data), mtime=0))
+        cache_file = str(self._get_cache_file(compressed_filename))
+        # Id is kept from the last run, so the file is updated in place without looking it up
+        file_id = self._load_file_ids().get(self._get_file_id_name(compressed_filename))
+        file = None
+        if file_id is not None:
+            file = self.drive.CreateFile({'id': file_id, 'mimeType': GZIP_MIME_TYPE})
+            file.SetContentFile(cache_file)
+            try:
+                file.Upload()
+            except ApiRequestError:
+                file = None
+        if file is None:
+            file = self._get_or_create_file({'title': compressed_filename}, self.root_folder_id, self._is_known_missing(compressed_filename))
+            file['mimeType'] = GZIP_MIME_TYPE
+            file.SetContentFile(cache_file)
+            file.Upload()
+            self._store_file_id(self._get_file_id_name(compressed_filename), file['id'])
+        self._file_cache[self._get_file_key({'title': compressed_filename}, self.root_folder_id)] = (time.monotonic(), file)
+        if filename in self._uncompressed_files:
+            self._uncompressed_files.discard(filename)
+            self._store_file_id(self._get_file_id_name(filename), None)
+            try:
+                self.delete_file(filename)
+            except FileDoesNotExistError:
+                pass
+
+    def _get_cache_file(self, filename):
+        return CACHE_FOLDER.joinpath(self.root_folder, filename)
+
+    def _load_cached(self, filename, md5_checksum):
+        if not md5_checksum:
+            return None
+        try:
+            content = self._get_cache_file(filename).read_bytes()
+        except FileNotFoundError:
+            return None
+        if hashlib.md5(content).hexdigest() != md5_checksum:
+            return None
+        return content
+
+    def _store_cached(self, filename, content):
+        cache_file = self._get_cache_file(filename)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_bytes(content)
 
     def load_file(self, filename, target):
         self._init_drive()
@@ -242,41 +619,89 @@ class GDriveFS(RemoteFS):
 
     def upload_file(self, filename, source):
         self._init_drive()
-        save_file = self._get_or_create_file({'title': filename}, self.root_folder_id)
+        save_file = self._get_or_create_file({'title': filename}, self.root_folder_id, self._is_known_missing(filename))
         save_file.SetContentFile(source)
         save_file.Upload()
 
+    def load_files(self, files):
+        self._init_drive()
+        return self._run_parallel(self.load_file, files)
+
+    def upload_files(self, files):
+        self._init_drive()
+        return self._run_parallel(self.upload_file, files)
+
+    def _run_parallel(self, func, args_list):
+        # Transfers are bound by request latency rather than bandwidth, so several are run at once.
+        # Pydrive keeps a separate http object per thread, so this is safe with one GoogleDrive instance.
+        if len(args_list) <= 1 or self.max_transfers <= 1:
+            return [self._try_transfer(func, *args) for args in args_list]
+        with ThreadPoolExecutor(max_workers=self.max_transfers) as executor:
+            futures = [executor.submit(func, *args) for args in args_list]
+        return [future.exception() for future in futures]
+
     def rename_file(self, filename, new_filename):
+        self._init_drive()
         file = self._get_file({'title': filename}, self.root_folder_id)
         file['title'] = new_filename
         file.Upload()
+        self._file_cache.pop(self._get_file_key({'title': filename}, self.root_folder_id), None)
+        self._file_cache[self._get_file_key({'title': new_filename}, self.root_folder_id)] = (time.monotonic(), file)
 
     def delete_file(self, filename):
         self._init_drive()
         file = self._get_file({'title': filename}, self.root_folder_id)
         file.Delete()
-    
+        self._file_cache.pop(self._get_file_key({'title': filename}, self.root_folder_id), None)
+
+    def _get_file_key(self, metadata, parent_id):
+        return (frozenset(metadata.items()), parent_id)
+
     def _get_file(self, metadata: dict[str, str], parent_id=None) -> GoogleDriveFile:
-        clauses = ["trashed = false"]
-        for name, value in metadata.items():
-            clauses.append(f"{name} = '{value}'")
-        if parent_id:
-            clauses.append(f"'{parent_id}' in parents")
-        else:
-            clauses.append("'root' in parents")
-        query = " and ".join(clauses)
-        results = self.drive.ListFile({'q': query}).GetList()
+        # A single operation tends to look up the same file several times, so lookups are briefly reused
+        key = self._get_file_key(metadata, parent_id)
+        cached = self._file_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < FILE_CACHE_TTL:
+            return cached[1]
+        query = build_query(tuple(metadata.items()), parent_id)
+        # Only the first match is used, so a single one-item page is requested
+        results = self.drive.ListFile({'q': query, 'maxResults': 1, 'fields': FILE_FIELDS}).GetList()
         if not results:
+            # An empty result may come from a stale cached root folder id
+            if parent_id is not None and parent_id == self.root_folder_id and not self._root_folder_verified:
+                if self._check_root_folder():
+                    return self._get_file(metadata, self.root_folder_id)
             raise FileDoesNotExistError()
+        if parent_id is not None and parent_id == self.root_folder_id:
+            # Found a file that isn't trashed in it, so the folder itself isn't stale
+            self._root_folder_verified = True
+        self._file_cache[key] = (time.monotonic(), results[0])
         return results[0]
 
-    def _get_or_create_file(self, metadata, parent_id=None):
-        try:
-            return self._get_file(metadata, parent_id)
-        except FileDoesNotExistError:
-            pass
+    def _is_known_missing(self, filename):
+        # Every file put into a root folder created by this instance is in the file cache,
+        # so anything else there can't exist yet and doesn't need to be looked up
+        if not self._root_folder_created:
+            return False
+        return self._get_file_key({'title': filename}, self.root_folder_id) not in self._file_cache
+
+    def _get_or_create_file(self, metadata, parent_id=None, assume_missing=False):
+        root_folder_id = self.root_folder_id
+        if not assume_missing:
+            try:
+                return self._get_file(metadata, parent_id)
+            except FileDoesNotExistError:
+                pass
+        if parent_id is not None and parent_id == root_folder_id:
+            # The lookup may have replaced a stale root folder id
+            parent_id = self.root_folder_id
+        return self._create_file(metadata, parent_id)
+
+    def _create_file(self, metadata, parent_id=None):
+        key = self._get_file_key(metadata, parent_id)
         if parent_id:
             metadata['parents'] = [{'id': parent_id}]
         new_file = self.drive.CreateFile(metadata)
         new_file.Upload()
+        self._file_cache[key] = (time.monotonic(), new_file)
         return new_file
\ No newline at end of file
@@ -1,6 +1,8 @@
+import os
 import sys
 import shutil
 from pathlib import Path
+from collections import deque
 from io import StringIO
 from typing import Any
 from unittest.mock import patch
@@ -99,29 +101,32 @@ class TestSuite():
 
 class InputMock():
     def __init__(self):
-        self.queue = []
+        self.queue = deque()
 
     def add_inputs(self, inputs):
-        self.queue = list(reversed(inputs)) + self.queue
+        # Answered in the order they were added
+        self.queue.extend(inputs)
     
     def __call__(self, prompt='') -> Any:
         if not self.queue:
             value = ''
         else:
-            value = self.queue.pop()
+            value = self.queue.popleft()
         print(f"{prompt}{value}")
         return value
 
 def print_ftree(folder_path, indent=0):
-    p = Path(folder_path)
-    for file in p.iterdir():
-        print(" "*indent, file.name, sep="")
-        if file.is_dir():
-            print_ftree(file, indent+2)
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            print(" "*indent, entry.name, sep="")
+            if entry.is_dir(follow_symlinks=False):
+                print_ftree(entry.path, indent+2)
 
 def create_file_structure(folder, structure):
+    # Wrapped once, subfolders are passed down as Path already
+    folder = Path(folder)
     for name, value in structure.items():
-        new_file = Path(folder).joinpath(name)
+        new_file = folder / name
         if isinstance(value, dict):
             new_file.mkdir()
             create_file_structure(new_file, value)
@@ -129,12 +134,13 @@ def create_file_structure(folder, structure):
             new_file.write_text(value)
 
 def clean_folder(folder):
-    for file in Path(folder).iterdir():
-        if file.is_dir():
-            clean_folder(file)
-            file.rmdir()
-        else:
-            file.unlink()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                clean_folder(entry.path)
+                os.rmdir(entry.path)
+            else:
+                os.unlink(entry.path)
 
 if __name__ == "__main__":
     TestSuite().test()
\ No newline at end of file
@@ -1,22 +1,38 @@
+import os
 import sys
 import shutil
 import re
 import json
+import gzip
+import hashlib
+import itertools
+import tempfile
+from collections import deque
+from datetime import datetime
+from zipfile import ZipFile
 from pathlib import Path
-import io
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Any, Iterable
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
+from pydrive.files import ApiRequestError
 import unittest
 import unittest.mock
 
+from common import DATETIME_FORMAT, AppError
+from local import Local, RegistryFile
 from pyCloudSave import Application
-from remote import FilebasedRemote, LocalFS, GDriveFS, FOLDER_MIME_TYPE, FileDoesNotExistError
+from remote import FilebasedRemote, SQLiteFilebasedRemote, LocalFS, GDriveFS, RemoteFS, FOLDER_MIME_TYPE, FileDoesNotExistError, TransferError, REGISTRY_FILENAME, SQLITE_SAVE_COLUMNS, copy_file
 
-TEMP_FOLDER = Path(__file__).parent.joinpath("temp")
-SAVE_FOLDER = TEMP_FOLDER.joinpath("save_folder")
-REMOTE_FOLDER = TEMP_FOLDER.joinpath("remote")
-LOCAL_REGISTRY = TEMP_FOLDER.joinpath("registry.json")
+ARG_RE = re.compile(r"\".*?\"|\'.*?\'|\S+")
+QUERY_CLAUSE_RE = re.compile(r"(\w+) = (?:'([^']*)'|(\w+))|'([^']*)' in parents")
+
+GDRIVE_TEMP_FOLDER = 'pyCloudSave_temp'
+
+# Test folders are created in memory backed /dev/shm where it's available
+TEMP_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None
 
 SAVE_STRUCTURE = {
     "data": {
@@ -28,196 +44,398 @@ SAVE_STRUCTURE = {
 }
 
 class AppTest(unittest.TestCase):
-    saves = {
-        'Grim Dawn': {
-            'save_folder': TEMP_FOLDER.joinpath('Grim Dawn')
-        },
-        'Shadows of Loathing': {
-            'save_folder': TEMP_FOLDER.joinpath('Shadows')
-        }
-    }
-    def setUp(self):
-        TEMP_FOLDER.mkdir(exist_ok=True)
-        SAVE_FOLDER.mkdir()
-        create_file_structure(SAVE_FOLDER, SAVE_STRUCTURE)
-        REMOTE_FOLDER.mkdir()
-        self.input_mock = InputMock()
-        self.input_patcher = unittest.mock.patch('pyCloudSave.input', self.input_mock)
-        self.input_patcher.start()
-        self.output_io = io.StringIO()
-        self.output_pathcher = unittest.mock.patch('pyCloudSave.sys.stdout', self.output_io)
-        self.output_pathcher.start()
-
-    def tearDown(self):
-        shutil.rmtree(TEMP_FOLDER)
-        self.output_pathcher.stop()
-        self.input_patcher.stop()
-
-    def invoke_command(self, command, inputs=None):
-        remote = FilebasedRemote(LocalFS(REMOTE_FOLDER))
-        app = Application(remote, LOCAL_REGISTRY)
-        if inputs:
-            self.input_mock.add_inputs(inputs)
-        app.parse_args(split_args(command))
-        return self.pop_output()
+    @classmethod
+    def setUpClass(cls):
+        # Save structure is written once and copied for every test
+        cls.pristine_dir = tempfile.TemporaryDirectory(dir=TEMP_ROOT)
+        write_flat_structure(cls.pristine_dir.name, SAVE_FOLDERS, SAVE_FILES)
 
-    def pop_output(self):
-        result = self.output_io.getvalue()
-        self.output_io.truncate(0)
-        self.output_io.seek(0)
-        return result
+    @classmethod
+    def tearDownClass(cls):
+        cls.pristine_dir.cleanup()
 
-class IntegrationTest(unittest.TestCase):
+    # Everything set up here is torn down through cleanups, in reverse order
     def setUp(self):
-        TEMP_FOLDER.mkdir(exist_ok=True)
-        SAVE_FOLDER.mkdir()
-        create_file_structure(SAVE_FOLDER, SAVE_STRUCTURE)
-        REMOTE_FOLDER.mkdir()
+        self.temp_folder = make_temp_folder(self)
+        self.save_folder = self.temp_folder.joinpath("save_folder")
+        self.local_registry = DictRegistry()
+        # Not hardlinked, tests write into the save folder and that would change the pristine files
+        shutil.copytree(self.pristine_dir.name, self.save_folder, copy_function=copy_file)
         self.input_mock = InputMock()
-        self.input_patcher = unittest.mock.patch('pyCloudSave.input', self.input_mock)
-        self.input_patcher.start()
-        self.output_io = io.StringIO()
-        self.output_pathcher = unittest.mock.patch('pyCloudSave.sys.stdout', self.output_io)
-        self.output_pathcher.start()
+        self.enter_patch('pyCloudSave.input', self.input_mock)
+        self.output_io = OutputCapture()
+        self.remote = FilebasedRemote(MemoryFS())
+        # Every path the app writes to is inside the test's own folder, so tests can run in parallel
+        self.app = Application(self.remote, self.local_registry, self.temp_folder.joinpath("temp"))
 
-    def tearDown(self):
-        shutil.rmtree(TEMP_FOLDER)
-        self.output_pathcher.stop()
-        self.input_patcher.stop()
+    def enter_patch(self, target, new):
+        patcher = unittest.mock.patch(target, new)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def invoke_command(self, command, inputs=None):
-        remote = FilebasedRemote(LocalFS(REMOTE_FOLDER))
-        app = Application(remote, LOCAL_REGISTRY)
         if inputs:
             self.input_mock.add_inputs(inputs)
-        app.parse_args(split_args(command))
+        with redirect_stdout(self.output_io):
+            self.app.parse_args(split_args(command))
         return self.pop_output()
 
+    def assertAllIn(self, members, container):
+        # Reports every missing member at once instead of stopping at the first
+        missing = [member for member in members if member not in container]
+        if missing:
+            self.fail(f"{missing!r} not found in {container!r}")
+
     def pop_output(self):
-        result = self.output_io.getvalue()
-        self.output_io.truncate(0)
-        self.output_io.seek(0)
+        result = ''.join(self.output_io.parts)
+        self.output_io.parts.clear()
         return result
 
+class IntegrationTest(AppTest):
     def test_app(self):
-        # Starting with an empty List
-        output = self.invoke_command("list")
-        self.assertEqual(output, "There are no currently tracked saves.\n")
-        output = self.invoke_command("remote list")
-        self.assertEqual(output, "There are no saves in a remote.\n")
-
-        # Tracking a new save
-        SAVE_NAME_1 = "Pascal's Wager"
-        LOOKUP_NAME_1 = "wager"
-        self.invoke_command(f'add {SAVE_NAME_1} -r "{SAVE_FOLDER}"')        
-        output = self.invoke_command("list")
-        self.assertIn(SAVE_NAME_1, output)
-        self.assertEqual(count_lines(output), 3)
-
-        # Checking saved data
-        output = self.invoke_command(f"show {LOOKUP_NAME_1}")
-        self.assertIn(SAVE_NAME_1, output)
-        self.assertIn(str(SAVE_FOLDER), output)
-
-        # Editing a save
-        save_filters = "*dat, !*save1*"
-        game_version = "1.23"
-        self.invoke_command(f'edit {LOOKUP_NAME_1} -f "{save_filters}" -v "{game_version}"')
-        output = self.invoke_command(f'show {LOOKUP_NAME_1}')
-        self.assertIn(save_filters, output)
-        self.assertIn(game_version, output)
-
-        # Upload with sync
-        self.invoke_command(f'sync {LOOKUP_NAME_1}')
-        output = self.invoke_command(r'remote list')
-        self.assertIn(SAVE_NAME_1, output)
-
-        # Edit again with remote
-        SAVE_NAME_2 = "F.E.A.R"
-        LOOKUP_NAME_2 = "fear"
-        NEW_GAME_VERSION = "2.6"
-        self.input_mock.add_inputs(["yes all"])
-        self.invoke_command(f'edit {LOOKUP_NAME_1} -n "{SAVE_NAME_2}" -v "{NEW_GAME_VERSION}"')
-        output = self.invoke_command('list')
-        self.assertNotIn(SAVE_NAME_1, output)
-        output = self.invoke_command(f'show {LOOKUP_NAME_2}')
-        self.assertIn(SAVE_NAME_2, output)
-        self.assertIn(str(SAVE_FOLDER), output)
-        self.assertIn(NEW_GAME_VERSION, output)
-        output = self.invoke_command('remote list')
-        self.assertNotIn(SAVE_NAME_1, output)
-        output = self.invoke_command(f'remote show {LOOKUP_NAME_2}')
-        self.assertIn(SAVE_NAME_2, output)
-        self.assertIn(NEW_GAME_VERSION, output)
-
-        # Delete local save files and load back
-        clean_folder(SAVE_FOLDER)
-        self.invoke_command(f"load {LOOKUP_NAME_2}")
-        self.assertCountEqual(list_files(SAVE_FOLDER), ['save2.dat'])
-
-        # Untrack local
-        self.invoke_command(f"untrack {LOOKUP_NAME_2}")
-        output = self.invoke_command("list")
-        self.assertNotIn(SAVE_NAME_2, output)
-        output = self.invoke_command('remote list')
-        self.assertIn(SAVE_NAME_2, output)
-
-        # Copy remote back into local
-        self.invoke_command(f"track -c {LOOKUP_NAME_2}")
-        output = self.invoke_command(f"show {LOOKUP_NAME_2}")
-        self.assertIn(SAVE_NAME_2, output)
-        self.assertIn(str(SAVE_FOLDER), output)
-
-        # Rename remote and try loading again (should get an error)
-        SAVE_NAME_3 = "Doom Eternal"
-        NEW_ROOT_HINT = "Games/Doom/saves"
-        self.invoke_command(f'remote edit {LOOKUP_NAME_2} --name "{SAVE_NAME_3}" -r "{NEW_ROOT_HINT}"')
-        output = self.invoke_command(f'remote show {SAVE_NAME_3}')
-        self.assertIn(NEW_ROOT_HINT, output)
+        with self.subTest("Starting with an empty List"):
+            output = self.invoke_command("list")
+            self.assertEqual(output, "There are no currently tracked saves.\n")
+            output = self.invoke_command("remote list")
+            self.assertEqual(output, "There are no saves in a remote.\n")
+
+        with self.subTest("Tracking a new save"):
+            SAVE_NAME_1 = "Pascal's Wager"
+            LOOKUP_NAME_1 = "wager"
+            self.invoke_command(f'add {SAVE_NAME_1} -r "{self.save_folder}"')
+            output = self.invoke_command("list")
+            self.assertIn(SAVE_NAME_1, output)
+            self.assertEqual(count_lines(output), 3)
+
+        with self.subTest("Checking saved data"):
+            output = self.invoke_command(f"show {LOOKUP_NAME_1}")
+            self.assertAllIn([SAVE_NAME_1, str(self.save_folder)], output)
+
+        with self.subTest("Editing a save"):
+            save_filters = "*dat, !*save1*"
+            game_version = "1.23"
+            self.invoke_command(f'edit {LOOKUP_NAME_1} -f "{save_filters}" -v "{game_version}"')
+            output = self.invoke_command(f'show {LOOKUP_NAME_1}')
+            self.assertAllIn([save_filters, game_version], output)
+
+        with self.subTest("Upload with sync"):
+            self.invoke_command(f'sync {LOOKUP_NAME_1}')
+            output = self.invoke_command(r'remote list')
+            self.assertIn(SAVE_NAME_1, output)
+
+        with self.subTest("Edit again with remote"):
+            SAVE_NAME_2 = "F.E.A.R"
+            LOOKUP_NAME_2 = "fear"
+            NEW_GAME_VERSION = "2.6"
+            self.input_mock.add_inputs(["yes all"])
+            self.invoke_command(f'edit {LOOKUP_NAME_1} -n "{SAVE_NAME_2}" -v "{NEW_GAME_VERSION}"')
+            output = self.invoke_command('list')
+            self.assertNotIn(SAVE_NAME_1, output)
+            output = self.invoke_command(f'show {LOOKUP_NAME_2}')
+            self.assertAllIn([SAVE_NAME_2, str(self.save_folder), NEW_GAME_VERSION], output)
+            output = self.invoke_command('remote list')
+            self.assertNotIn(SAVE_NAME_1, output)
+            output = self.invoke_command(f'remote show {LOOKUP_NAME_2}')
+            self.assertAllIn([SAVE_NAME_2, NEW_GAME_VERSION], output)
+
+        with self.subTest("Delete local save files and load back"):
+            clean_folder(self.save_folder)
+            self.invoke_command(f"load {LOOKUP_NAME_2}")
+            self.assertCountEqual(list_files(self.save_folder), ['save2.dat'])
+
+        with self.subTest("Untrack local"):
+            self.invoke_command(f"untrack {LOOKUP_NAME_2}")
+            output = self.invoke_command("list")
+            self.assertNotIn(SAVE_NAME_2, output)
+            output = self.invoke_command('remote list')
+            self.assertIn(SAVE_NAME_2, output)
+
+        with self.subTest("Copy remote back into local"):
+            self.invoke_command(f"track -c {LOOKUP_NAME_2}")
+            output = self.invoke_command(f"show {LOOKUP_NAME_2}")
+            self.assertAllIn([SAVE_NAME_2, str(self.save_folder)], output)
+
+        with self.subTest("Rename remote and try loading again (should get an error)"):
+            SAVE_NAME_3 = "Doom Eternal"
+            NEW_ROOT_HINT = "Games/Doom/saves"
+            self.invoke_command(f'remote edit {LOOKUP_NAME_2} --name "{SAVE_NAME_3}" -r "{NEW_ROOT_HINT}"')
+            output = self.invoke_command(f'remote show {SAVE_NAME_3}')
+            self.assertIn(NEW_ROOT_HINT, output)
+            output = self.invoke_command('remote list')
+            self.assertNotIn(SAVE_NAME_2, output)
+            self.assertIn(SAVE_NAME_3, output)
+            output = self.invoke_command(f'load {SAVE_NAME_2}')
+            self.assertEqual(f"Save {SAVE_NAME_2} is not present in remote\n", output)
+
+        with self.subTest("Delete remote"):
+            self.invoke_command(f"remote delete {SAVE_NAME_3}")
+            output = self.invoke_command("remote list")
+            self.assertNotIn(SAVE_NAME_3, output)
+
+class TransferErrorTest(AppTest):
+    def setUp(self):
+        super().setUp()
+        self.invoke_command(f'add "Game A" -r "{self.save_folder}"')
+        self.invoke_command(f'add "Game B" -r "{self.save_folder}"')
+        self.fs = self.remote.fs
+
+    def testUploadRecordsSavesThatWentThrough(self):
+        upload_file = self.fs.upload_file
+        def failing_upload(filename, source):
+            if filename.startswith('game_b'):
+                raise OSError("Connection reset")
+            upload_file(filename, source)
+        self.fs.upload_file = failing_upload
+        output = self.invoke_command('sync --all')
+        self.assertAllIn(["Save Game A uploaded.", "Transfer of save game_b failed: Connection reset"], output)
+        self.assertNotIn("Save Game B uploaded.", output)
+        self.assertIsNotNone(self.remote.get_save('game_a')['last_upload'])
+        self.assertIsNone(self.remote.get_save('game_b')['last_upload'])
+        self.assertIsNotNone(self.app.local.get_save('game_a').get('last_sync'))
+        self.assertIsNone(self.app.local.get_save('game_b').get('last_sync'))
+        # Failed save stays registered on the remote without a size
         output = self.invoke_command('remote list')
-        self.assertNotIn(SAVE_NAME_2, output)
-        self.assertIn(SAVE_NAME_3, output)
-        output = self.invoke_command(f'load {SAVE_NAME_2}')
-        self.assertEqual(f"Save {SAVE_NAME_2} is not present in remote\n", output)
+        self.assertAllIn(["Game A", "Game B"], output)
+        output = self.invoke_command('remote show "Game B"')
+        self.assertIn("Game B", output)
+        output = self.invoke_command('show "Game B"')
+        self.assertIn("Game B", output)
+
+    def testLoadNamesOnlyMissingSave(self):
+        self.invoke_command('sync --all')
+        del self.fs.files[self.remote._get_filesave_name('game_b')]
+        loads = [(id_name, self.temp_folder / id_name) for id_name in ('game_a', 'game_b')]
+        with self.assertRaises(TransferError) as context:
+            self.remote.load_saves(loads)
+        self.assertEqual(list(context.exception.errors), ['game_b'])
+        self.assertEqual(context.exception.message, "Save game_b is not present in remote.")
+        self.assertTrue(self.temp_folder.joinpath('game_a').exists())
+
+class RegistryFileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = make_temp_folder(self)
+        self.registry_path = self.temp_folder.joinpath("registry.json")
+        self.registry_file = RegistryFile(self.registry_path)
+
+    def make_save(self, name, last_sync=None):
+        return {'name': name, 'root': str(self.temp_folder), 'filters': "", 'version': None, 'last_sync': last_sync}
+
+    def testReplaySetAndDelete(self):
+        self.registry_file.save({'a': self.make_save("A")})
+        self.registry_file.append([
+            {'op': 'set', 'id': 'b', 'save': self.make_save("B")},
+            {'op': 'set', 'id': 'a', 'save': self.make_save("A", 1.5)},
+            {'op': 'delete', 'id': 'b'}
+        ], 1)
+        registry_file = RegistryFile(self.registry_path)
+        self.assertEqual({'a': self.make_save("A", 1.5)}, registry_file.load())
+        self.assertEqual(3, registry_file.journal_length)
+
+    def testCompaction(self):
+        local = Local(self.registry_path)
+        local.track("A", str(self.temp_folder))
+        local.edit('a', last_sync=1.0)
+        self.assertTrue(self.registry_file.journal_file.exists())
+        # Third record is past twice the registry size, so the journal is merged into the registry file
+        local.edit('a', last_sync=2.0)
+        self.assertFalse(self.registry_file.journal_file.exists())
+        with open(self.registry_path) as fio:
+            self.assertEqual(2.0, json.load(fio)['saves']['a']['last_sync'])
+        self.assertEqual(2.0, Local(self.registry_path).get_save('a')['last_sync'])
+
+    def testTruncatedLastRecord(self):
+        self.registry_file.append([{'op': 'set', 'id': 'a', 'save': self.make_save("A")}], 1)
+        with open(self.registry_file.journal_file, 'ab') as fio:
+            fio.write(b'{"op": "set", "id": "b", "sa')
+        self.assertEqual({'a': self.make_save("A")}, RegistryFile(self.registry_path).load())
+        # Damaged journal is rewritten into the registry file, so new records aren't appended after it
+        self.assertFalse(self.registry_file.journal_file.exists())
+        with open(self.registry_path) as fio:
+            self.assertEqual({'a': self.make_save("A")}, json.load(fio)['saves'])
+
+    def testLoadLegacyRegistry(self):
+        last_sync = datetime(2023, 5, 17, 12, 30, 15)
+        data = {'version': "1.0", 'saves': {
+            'a': self.make_save("A", last_sync.strftime(DATETIME_FORMAT)),
+            'b': self.make_save("B")
+        }}
+        with open(self.registry_path, 'w') as fio:
+            json.dump(data, fio)
+        registry = self.registry_file.load()
+        self.assertEqual(last_sync.timestamp(), registry['a']['last_sync'])
+        self.assertIsNone(registry['b']['last_sync'])
+
+class LocalTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = make_temp_folder(self)
+        self.save_folder = self.temp_folder.joinpath("save_folder")
+        structure = {
+            "profiles": {
+                "first": {"profile.sav": "First", "profile.bak": "First backup"},
+                "second": {"profile.sav": "Second"}
+            },
+            "settings.cfg": "Some settings",
+            "save1.sav": "Save data 1"
+        }
+        write_flat_structure(self.save_folder, *flatten_structure(structure))
+        self.local = Local(DictRegistry())
+
+    def testNestedFolderFilters(self):
+        self.local.track("Game", str(self.save_folder), "profiles/*.sav, !*second*")
+        archive = self.temp_folder.joinpath("game.zip")
+        self.local.pack_save_files('game', archive)
+        with ZipFile(archive) as zf:
+            names = zf.namelist()
+        self.assertEqual(['profiles/first/profile.sav'], names)
+
+class SQLiteFilebasedRemoteTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = make_temp_folder(self)
+        self.fs = MemoryFS()
+        self.remote = self.create_remote()
+
+    def create_remote(self):
+        # Every instance gets its own database file, as if it ran on another machine
+        return SQLiteFilebasedRemote(self.fs, tempfile.mktemp(suffix='.db', dir=self.temp_folder))
+
+    def assertSameSaves(self, expected, registry):
+        # Database keeps a size for every save, json registry only for uploaded ones
+        def get_rows(registry):
+            return {id_name: tuple(save.get(column) for column in SQLITE_SAVE_COLUMNS) for id_name, save in registry.items()}
+        self.assertEqual(get_rows(expected), get_rows(registry))
+
+    def testCarryOverJsonRegistry(self):
+        json_remote = FilebasedRemote(self.fs)
+        json_remote.register_new_save("Game A", "C:/Games/A", "*.sav", "1.2")
+        json_remote.register_new_save("Game B")
+        self.assertSameSaves(json_remote.get_registry(), self.remote.get_registry())
+        self.assertSameSaves(json_remote.get_registry(), self.create_remote().get_registry())
+        # Json registry is no longer updated, so it can't be used anymore
+        with self.assertRaises(AppError):
+            FilebasedRemote(self.fs).get_registry()
+
+    def testCarryOverLegacyRegistryOnce(self):
+        last_upload = datetime(2023, 5, 17, 12, 30, 15)
+        self.fs.upload_json(REGISTRY_FILENAME, {'version': "1.0", 'saves': {'game_a': {
+            'name': "Game A", 'root_hint': None, 'filters_hint': None, 'version': None,
+            'last_upload': last_upload.strftime(DATETIME_FORMAT)
+        }}})
+        with unittest.mock.patch.object(self.fs, 'upload_file', wraps=self.fs.upload_file) as upload_file:
+            registry = self.remote.get_registry()
+        self.assertEqual(last_upload.timestamp(), registry['game_a']['last_upload'])
+        upload_file.assert_called_once()
+        self.assertSameSaves(registry, self.create_remote().get_registry())
+
+    def testDefaultDatabasePerRemote(self):
+        other_fs = MemoryFS()
+        first = SQLiteFilebasedRemote(self.fs)
+        second = SQLiteFilebasedRemote(other_fs)
+        first.register_new_save("Game A")
+        second.register_new_save("Game B")
+        first.register_new_save("Game C")
+        self.assertEqual(['game_a', 'game_c'], sorted(SQLiteFilebasedRemote(self.fs).get_registry()))
+        self.assertEqual(['game_b'], sorted(SQLiteFilebasedRemote(other_fs).get_registry()))
+
+    def testUploadRenameReload(self):
+        source = self.temp_folder.joinpath('save.zip')
+        source.write_bytes(b'Save data')
+        self.remote.register_new_save("Game A")
+        self.remote.register_new_save("Game B")
+        self.remote.upload_saves([('game_a', source, 12.5), ('game_b', source, 12.5)])
+        self.remote.edit_save('game_a', new_name="Game C", version="2")
+        self.remote.delete_save('game_b')
+        registry = self.create_remote().get_registry()
+        self.assertEqual(['game_c'], list(registry))
+        save = registry['game_c']
+        self.assertEqual(("Game C", "2", 12.5, len(b'Save data')), (save['name'], save['version'], save['last_upload'], save['size']))
+        self.assertEqual(b'Save data', self.fs.files['game_c.zip'])
+        self.assertNotIn(REGISTRY_FILENAME, self.fs.files)
+
+class LocalFSTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = make_temp_folder(self)
+        self.fs = LocalFS(self.temp_folder.joinpath("remote"))
+
+    def testUploadJsonLoadJson(self):
+        test_data = {'1 1': 2, '3 3': '4', '5 5': None, '6 6': False}
+        self.fs.upload_json('test_file1.json', test_data)
+        self.assertEqual(test_data, self.fs.load_json('test_file1.json'))
+
+    def testUploadFileLoadFile(self):
+        local_file = self.temp_folder.joinpath('test_file2.zip')
+        local_target = self.temp_folder.joinpath('test_file2_target.zip')
+        local_file.write_text('Foo Bar')
+        self.fs.upload_file('test_file2.zip', local_file)
+        self.fs.load_file('test_file2.zip', local_target)
+        self.assertEqual('Foo Bar', local_target.read_text())
 
-        # Delete remote
-        self.invoke_command(f"remote delete {SAVE_NAME_3}")
-        output = self.invoke_command("remote list")
-        self.assertNotIn(SAVE_NAME_3, output)
+    def testRenameFile(self):
+        self.fs.upload_json('test_file3.json', {})
+        self.fs.rename_file('test_file3.json', 'test_file3_renamed.json')
+        with self.assertRaises(FileDoesNotExistError):
+            self.fs.load_json('test_file3.json')
+        self.assertEqual({}, self.fs.load_json('test_file3_renamed.json'))
+
+    def testDeleteFile(self):
+        self.fs.upload_json('test_file4.json', {})
+        self.fs.delete_file('test_file4.json')
+        with self.assertRaises(FileDoesNotExistError):
+            self.fs.load_file('test_file4.json', self.temp_folder.joinpath('test_file4.json'))
 
 class GDriveFSTest(unittest.TestCase):
+    # Runs against an in memory drive, GDriveFSLiveTest runs the same tests against a real one
     @classmethod
     def setUpClass(cls):
-        cls.local_temp_folder = Path(__file__).parent.joinpath("temp")
-        cls.local_temp_folder.mkdir(exist_ok=True)
-        temp_folder_name = 'pyCloudSave_temp'
-        gauth = GoogleAuth()
-        gauth.LocalWebserverAuth()
-        cls.drive = GoogleDrive(gauth)
-        cls.remote_temp_folder = cls.drive.CreateFile({'title': temp_folder_name, 'mimeType': FOLDER_MIME_TYPE})
-        cls.remote_temp_folder.Upload()
-        cls.gDriveFS = GDriveFS(temp_folder_name)
-    
+        cls.drive = FakeDrive()
+        cls.enter_class_patch('remote.GoogleAuth', FakeAuth)
+        cls.enter_class_patch('remote.GoogleDrive', lambda gauth: cls.drive)
+        cls.enter_class_patch('remote.GDriveFS._drives', {})
+        cls.remote_temp_folder = create_gdrive_folder(cls.drive, GDRIVE_TEMP_FOLDER)
+        cls.addClassCleanup(cls.remote_temp_folder.Delete)
+        cls.create_local_fixtures()
+
     @classmethod
-    def tearDownClass(cls):
-        shutil.rmtree(cls.local_temp_folder)
-        cls.remote_temp_folder.Delete()
+    def enter_class_patch(cls, target, new):
+        patcher = unittest.mock.patch(target, new)
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+
+    @classmethod
+    def create_local_fixtures(cls):
+        # Folder ids and cached files are kept out of the user's own, for the live drive too
+        state_dir = Path(tempfile.mkdtemp(dir=TEMP_ROOT))
+        cls.addClassCleanup(shutil.rmtree, state_dir)
+        cls.enter_class_patch('remote.DRIVE_IDS_FILE', state_dir.joinpath('drive_ids.json'))
+        cls.enter_class_patch('remote.CACHE_FOLDER', state_dir.joinpath('cache'))
+        cls.local_temp_folder = Path(tempfile.mkdtemp(dir=TEMP_ROOT))
+        cls.addClassCleanup(shutil.rmtree, cls.local_temp_folder)
+
+    def setUp(self):
+        # New instance for every test, so file lookups cached by an earlier test aren't reused
+        self.gDriveFS = GDriveFS(GDRIVE_TEMP_FOLDER)
 
     def tearDown(self):
         clean_folder(self.local_temp_folder)
         for file in self.drive.ListFile({'q': f"'{self.remote_temp_folder['id']}' in parents"}).GetList():
             file.Delete()
         
-    def testUploadJsonLoadFile(self):
+    def testUploadJsonLoadJson(self):
         test_data = {'1 1': 2, '3 3': '4', '5 5': None, '6 6': False}
         filename = 'test_file1.json'
-        local_file = self.local_temp_folder.joinpath(filename)
         self.gDriveFS.upload_json(filename, test_data)
-        self.gDriveFS.load_file(filename, str(local_file))
-        with open(local_file) as fio:
-            result = json.load(fio)
+        result = self.gDriveFS.load_json(filename)
         self.assertEqual(test_data, result)
 
+    def testUploadJsonStoredCompressed(self):
+        test_data = {'1 1': 2, '3 3': '4', '5 5': None, '6 6': False}
+        filename = 'test_file6.json'
+        local_file = self.local_temp_folder.joinpath(filename)
+        self.gDriveFS.upload_json(filename, test_data)
+        with self.assertRaises(FileDoesNotExistError):
+            self.gDriveFS.load_file(filename, local_file)
+        self.gDriveFS.load_file(filename + '.gz', local_file)
+        self.assertEqual(test_data, json.loads(gzip.decompress(local_file.read_bytes())))
+
     def testUploadFileLoadJson(self):
         test_data = {'1 1': 2, '3 3': '4', '5 5': None, '6 6': False}
         filename = 'test_file2.json'
@@ -251,58 +469,271 @@ class GDriveFSTest(unittest.TestCase):
         self.gDriveFS.delete_file(filename)
         with self.assertRaises(FileDoesNotExistError):
             self.gDriveFS.load_file(filename, local_file)
-        
+
+    def testUploadIntoStaleRootFolder(self):
+        folder_name = GDRIVE_TEMP_FOLDER + '_stale'
+        first_fs = GDriveFS(folder_name)
+        first_fs.upload_json('test_file5.json', {})
+        stale_folder = self.drive.CreateFile({'id': first_fs.root_folder_id})
+        self.addCleanup(stale_folder.Delete)
+        stale_folder.Trash()
+        local_file = self.local_temp_folder.joinpath('test_file5.zip')
+        local_file.write_text("Foo Bar")
+        second_fs = GDriveFS(folder_name)
+        second_fs.upload_file('test_file5.zip', local_file)
+        self.addCleanup(self.drive.CreateFile({'id': second_fs.root_folder_id}).Delete)
+        self.assertNotEqual(first_fs.root_folder_id, second_fs.root_folder_id)
+        files = self.drive.ListFile({'q': f"'{second_fs.root_folder_id}' in parents and trashed = false"}).GetList()
+        self.assertEqual(['test_file5.zip'], [file['title'] for file in files])
+
+@unittest.skipUnless(os.environ.get('RUN_GDRIVE_LIVE'), "set RUN_GDRIVE_LIVE=1 to run against a real Google Drive")
+class GDriveFSLiveTest(GDriveFSTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.drive, cls.remote_temp_folder = get_live_drive()
+        cls.create_local_fixtures()
+
+# Live drive and its temp folder are set up once for the whole module, on first use
+live_drive = None
+live_temp_folder = None
+
+def get_live_drive():
+    global live_drive, live_temp_folder
+    if live_drive is None:
+        gauth = GoogleAuth()
+        gauth.LocalWebserverAuth()
+        live_drive = GoogleDrive(gauth)
+        live_temp_folder = create_gdrive_folder(live_drive, GDRIVE_TEMP_FOLDER)
+    return live_drive, live_temp_folder
+
+def tearDownModule():
+    if live_temp_folder is not None:
+        live_temp_folder.Delete()
+
+def create_gdrive_folder(drive, title):
+    folder = drive.CreateFile({'title': title, 'mimeType': FOLDER_MIME_TYPE})
+    folder.Upload()
+    return folder
+
+class FakeAuth():
+    def __init__(self, settings_file=None):
+        pass
+
+    def LocalWebserverAuth(self):
+        pass
+
+class FakeDrive():
+    # Keeps files in memory and supports only the calls GDriveFS makes
+    def __init__(self):
+        self.files: dict[str, dict[str, Any]] = {}
+        self.ids = itertools.count(1)
+
+    def CreateFile(self, metadata=None):
+        return FakeDriveFile(self, metadata)
+
+    def ListFile(self, param):
+        return FakeFileList(self, param)
+
+class FakeDriveFile(dict):
+    def __init__(self, drive, metadata=None):
+        super().__init__(metadata or {})
+        self.drive = drive
+        self.content = None
+
+    def SetContentFile(self, filename):
+        self.content = Path(filename).read_bytes()
+
+    def GetContentFile(self, filename):
+        Path(filename).write_bytes(self._get_record()['content'])
+
+    def Trash(self):
+        self._get_record()['metadata']['trashed'] = True
+
+    def FetchMetadata(self, fields=None):
+        self.update(self._get_record()['metadata'])
+
+    def Upload(self):
+        if 'id' not in self:
+            self['id'] = str(next(self.drive.ids))
+            self.drive.files[self['id']] = {'metadata': {'trashed': False}, 'content': b''}
+        record = self._get_record()
+        if self.content is not None:
+            record['content'] = self.content
+            self['md5Checksum'] = hashlib.md5(self.content).hexdigest()
+        record['metadata'].update(self)
+        self.update(record['metadata'])
+
+    def Delete(self):
+        self._get_record()
+        del self.drive.files[self['id']]
+
+    def _get_record(self):
+        try:
+            return self.drive.files[self['id']]
+        except KeyError:
+            raise ApiRequestError(f"File not found: {self['id']}") from None
+
+class FakeFileList():
+    def __init__(self, drive, param):
+        self.drive = drive
+        self.param = param
+
+    def GetList(self):
+        clauses = self.param['q'].split(" and ")
+        results = [
+            FakeDriveFile(self.drive, record['metadata'])
+            for record in self.drive.files.values()
+            if all(self._matches(clause, record['metadata']) for clause in clauses)
+        ]
+        return results[:self.param.get('maxResults')]
+
+    @staticmethod
+    def _matches(clause, metadata):
+        field, value, keyword, parent_id = QUERY_CLAUSE_RE.fullmatch(clause).groups()
+        if parent_id is not None:
+            return parent_id in ([parent['id'] for parent in metadata.get('parents', [])] or ['root'])
+        if keyword is not None:
+            return str(metadata.get(field)).lower() == keyword
+        return metadata.get(field) == value
 
 class InputMock():
     def __init__(self):
-        self.queue = []
+        self.queue = deque()
 
     def add_inputs(self, inputs: Iterable[str]):
-        self.queue = list(reversed(inputs)) + self.queue
+        # Answered in the order they were added
+        self.queue.extend(inputs)
     
     def __call__(self, prompt='') -> Any:
         if not self.queue:
             value = ''
         else:
-            value = self.queue.pop()
+            value = self.queue.popleft()
         print(f"{prompt}{value}")
         return value
 
+class OutputCapture():
+    # Written parts are only joined when the output is read
+    def __init__(self):
+        self.parts = []
+
+    def write(self, string):
+        self.parts.append(string)
+        return len(string)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def writable(self):
+        return True
+
+class DictRegistry():
+    # Local registry storage kept in memory
+    def __init__(self):
+        self.registry = {}
+
+    def load(self):
+        return {id_name: dict(save) for id_name, save in self.registry.items()}
+
+    def save(self, registry):
+        self.registry = registry
+
+class MemoryFS(RemoteFS):
+    # Keeps remote files in memory, so the app tests don't touch the disk for the remote side
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+
+    def load_json(self, filename):
+        return json.loads(self._get_content(filename))
+
+    def upload_json(self, filename, data):
+        self.files[filename] = json.dumps(data).encode('utf-8')
+
+    def load_file(self, filename, target):
+        Path(target).write_bytes(self._get_content(filename))
+
+    def upload_file(self, filename, source):
+        self.files[filename] = Path(source).read_bytes()
+
+    def rename_file(self, filename, new_filename):
+        self.files[new_filename] = self._get_content(filename)
+        del self.files[filename]
+
+    def delete_file(self, filename):
+        self._get_content(filename)
+        del self.files[filename]
+
+    def _get_content(self, filename):
+        try:
+            return self.files[filename]
+        except KeyError:
+            raise FileDoesNotExistError() from None
+
+def make_temp_folder(testcase):
+    # Removed with the test's cleanups
+    temp_dir = tempfile.TemporaryDirectory(dir=TEMP_ROOT)
+    testcase.addCleanup(temp_dir.cleanup)
+    return Path(temp_dir.name)
+
 def split_args(string):
-    result = re.findall(r"\".*?\"|\'.*?\'|\S+", string)
-    return [arg.strip('"') for arg in result]
+    # Parser gets a fresh list, the cached tuple is shared between calls
+    return list(split_args_cached(string))
+
+# Tests run the same commands over and over
+@lru_cache(maxsize=256)
+def split_args_cached(string):
+    return tuple(arg.strip('"') for arg in ARG_RE.findall(string))
 
 def count_lines(string):
-    return len(re.findall(r"^.*?\S+.*?$", string, flags=re.M))
+    return sum(1 for line in string.splitlines() if line.strip())
 
 def list_files(folder):
-    p = Path(folder)
     result = []
-    for file in p.glob("**/*"):
-        if not file.is_file():
-            continue
-        result.append(str(file.relative_to(p)))
+    folders = [(os.fspath(folder), '')]
+    while folders:
+        path, prefix = folders.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append((entry.path, prefix + entry.name + os.sep))
+                elif entry.is_file():
+                    result.append(prefix + entry.name)
     return result
 
-def create_file_structure(folder, structure):
+def flatten_structure(structure, prefix=''):
+    # Returns relative folder paths, parents first, and (relative path, content) pairs for files
+    folders = []
+    files = []
     for name, value in structure.items():
-        new_file = Path(folder).joinpath(name)
+        path = os.path.join(prefix, name)
         if isinstance(value, dict):
-            new_file.mkdir()
-            create_file_structure(new_file, value)
+            folders.append(path)
+            sub_folders, sub_files = flatten_structure(value, path)
+            folders.extend(sub_folders)
+            files.extend(sub_files)
         else:
-            new_file.write_text(value)
+            files.append((path, value.encode('utf-8')))
+    return folders, files
+
+def write_flat_structure(folder, folders, files):
+    # Folders are created up front, then files are written in parallel
+    for path in folders:
+        os.makedirs(os.path.join(folder, path), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda file: Path(folder, file[0]).write_bytes(file[1]), files))
 
 def clean_folder(folder):
-    for file in Path(folder).iterdir():
-        if file.is_dir():
-            clean_folder(file)
-            file.rmdir()
-        else:
-            file.unlink()
+    shutil.rmtree(folder)
+    Path(folder).mkdir()
 
 def clean_gdrive_folder(folder_id: str, drive: GoogleDrive):
     for file in drive.ListFile({'q': f"'{folder_id}' in parents and trashed = false"}).GetList():
         if file['mimeType'] == FOLDER_MIME_TYPE:
             clean_gdrive_folder(file['id'], drive)
-        file.Delete()
\ No newline at end of file
+        file.Delete()
+
+# Flattened once, every test writes the same structure
+SAVE_FOLDERS, SAVE_FILES = flatten_structure(SAVE_STRUCTURE)